@@ -1,10 +1,17 @@
-from time import time, sleep
+import asyncio
+import os
+import shutil
+from time import time
 from functools import wraps
-from requests import post, request, RequestException, HTTPError
+import httpx
+from requests import Session, RequestException, HTTPError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 from .helpers import flatten_dict
-import pandas as pd
-import json
+import pyarrow as pa
+import pyarrow.parquet as pq
+import orjson
 
 class SellsyAPI:
     """A class to interact with the Sellsy API, handling authentication and requests."""
@@ -35,7 +42,18 @@ class SellsyAPI:
         }
         self.client_id = client_id
         self.client_secret = client_secret
+        # Session partagée : réutilise les connexions TCP/TLS (keep-alive) entre les requêtes.
+        # Les retries sont gérés par urllib3 au niveau de l'adaptateur : backoff
+        # exponentiel, prise en compte de Retry-After, sans bloquer de code Python
+        retry = Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset({'GET', 'POST'}),
+                      respect_retry_after_header=True)
+        self._session = Session()
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                                                    max_retries=retry))
         self.access_token, self.token_expiry = self._request_new_token()
+        self._session.headers.update({"Authorization": f"Bearer {self.access_token}"})
         self.with_custom_fields = with_custom_fields
         if self.with_custom_fields:
             self.fetch_custom_field_ids()
@@ -46,6 +64,7 @@ class SellsyAPI:
         """
         if time() >= self.token_expiry:
             self.access_token, self.token_expiry = self._request_new_token()
+            self._session.headers.update({"Authorization": f"Bearer {self.access_token}"})
         return self.access_token
 
     def _request_new_token(self) -> (str, float):
@@ -59,7 +78,7 @@ class SellsyAPI:
             RuntimeError: If the request for a new token fails.
         """
         try:
-            response = post(self.auth_url, data={
+            response = self._session.post(self.auth_url, data={
                 "grant_type": "client_credentials",
                 "client_id": self.client_id,
                 "client_secret": self.client_secret
@@ -81,32 +100,33 @@ class SellsyAPI:
     @_check_access_token
     def _simple_request(self, method: str, endpoint: str, params: dict = None, data: dict = None) -> dict:
 
-        MAX_RETRIES = 5
         params = params or {}
         params.setdefault('limit', 100)
         params.setdefault('order', 'id')
         params.setdefault('direction', 'asc')
 
         data = data or {}
-        headers = {"Authorization": f"Bearer {self.access_token}"}
         url = f"{self.api_base_url}{endpoint}"
-        retries = 0
-        while retries < MAX_RETRIES:
-            try:
-                response = request(method, url, headers=headers, params=params, data=data, timeout=10)  # Add timeout argument
-                response.raise_for_status()
-                return response.json()
-            except RequestException as err:
-                retries += 1
-                sleep(2 ** retries)  # Exponential backoff
-                if retries == MAX_RETRIES:
-                    raise Exception(f"All retries failed for {endpoint}: {e}") from err
+        try:
+            # Les retries (connexion comme statuts 429/5xx) sont portés par
+            # l'adaptateur de la session
+            response = self._session.request(method, url, params=params, data=data, timeout=10)  # Add timeout argument
+            response.raise_for_status()
+            # orjson décode les gros payloads imbriqués bien plus vite que le
+            # json.loads de la stdlib utilisé par response.json()
+            return orjson.loads(response.content)
+        except RequestException as err:
+            raise Exception(f"All retries failed for {endpoint}: {err}") from err
 
     def fetch_custom_field_ids(self) -> None:
         """
         Fetches all custom field IDs and their related objects from the API and stores them in self.custom_fields.
         """
         self.custom_fields = {}
+        # id de champ -> nom + table id d'item -> label, pour résoudre les
+        # valeurs en un accès dict au lieu de rebalayer parameters['items']
+        # pour chaque valeur de chaque ligne
+        self._cf_meta = {}
         endpoint = "custom-fields"
         params = {"order": "id", "direction": "asc", "limit": 100}
         offset = 0
@@ -121,6 +141,11 @@ class SellsyAPI:
                     if related_object not in self.custom_fields:
                         self.custom_fields[related_object] = []
                     self.custom_fields[related_object].append(field['id'])
+                items = (field.get('parameters') or {}).get('items') or []
+                self._cf_meta[field['id']] = {
+                    'name': field['name'],
+                    'items': {item['id']: item['label'] for item in reversed(items)},
+                }
 
             # Pagination handling
             pagination_info = response.get('pagination', {})
@@ -128,119 +153,243 @@ class SellsyAPI:
                 break
             offset += params['limit']
 
+        # Liste combinée calculée une seule fois. Surtout, ne pas étendre la
+        # liste de self.custom_fields['client'] à chaque get() : c'est le même
+        # objet, et chaque appel regonflerait les embed[] des appels suivants
+        self._all_custom_field_ids = []
+        for related_object in ['client', 'prospect', 'contact', 'opportunity', 'document', 'supplier', 'purchase']:
+            self._all_custom_field_ids.extend(self.custom_fields.get(related_object, []))
+
     @_check_access_token
-    def get(self, endpoint: str, params: dict, custom_fields=None, pagination=None) -> dict:
+    def get(self, endpoint: str, params: dict, custom_fields=None, pagination=None, out_dir=None):
+        """
+        Fetches all pages of an endpoint, custom fields included, and streams
+        them page by page into a partitioned Parquet dataset so memory stays
+        flat whatever the total volume.
+
+        Synchronous wrapper around `_get_async` so callers keep the same
+        blocking interface while pages are downloaded concurrently.
+
+        Returns:
+            tuple: The dataset directory and the last pagination offset.
+        """
+        return asyncio.run(self._get_async(endpoint, params,
+                                           custom_fields=custom_fields,
+                                           pagination=pagination,
+                                           out_dir=out_dir))
+
+    async def _get_async(self, endpoint: str, params: dict, custom_fields=None, pagination=None, out_dir=None):
 
         # initial informations
         MAX_RETRIES = 5
         CUSTOM_FIELDS_PER_REQUEST = 300
+        MAX_CONCURRENT_PAGES = 8
+        # Écrire le point de reprise à chaque page : le fichier fait ~100 octets
+        # face à une page qui coûte un aller-retour réseau, et toute page
+        # absente du checkpoint serait retéléchargée (donc dupliquée) à la reprise
+        CHECKPOINT_EVERY = 1  # pages
 
         params = params or {}
         params.setdefault('limit', 100)
         params.setdefault('order', 'created_at')
         params.setdefault('direction', 'desc')
 
-        headers = {"Authorization": f"Bearer {self.access_token}"}
         url = f"{self.api_base_url}{endpoint}"
+        if out_dir is None:
+            out_dir = f"{endpoint}-{custom_fields}-parquet"
+        if pagination is None:
+            # Démarrage à zéro : write_to_dataset ne fait qu'ajouter des
+            # fragments, donc un dataset d'une exécution précédente doit être
+            # purgé sous peine de dupliquer chaque ligne au rechargement
+            shutil.rmtree(out_dir, ignore_errors=True)
+            try:
+                os.remove(f"{out_dir}.ckpt")
+            except FileNotFoundError:
+                pass
 
-        # Determine the entity type from the endpoint
         # client, prospect, contact, opportunity, document, supplier, purchase
-        custom_field_ids = self.custom_fields.get('client', [])
-        for item in ['prospect', 'contact', 'opportunity', 'document', 'supplier', 'purchase']:
-            custom_field_ids.extend(self.custom_fields.get(item, []))
+        custom_field_ids = self._all_custom_field_ids
 
         # Start of script
         # Si la pagination est fournie, l'utiliser pour initialiser le paramètre 'offset'
         if pagination is not None:
             params['offset'] = pagination
+        start_offset = int(pagination) if pagination is not None else 0
 
-        # Fetch initial batch of data
-        params['embed[]'] = [f"cf.{cf_id}" for cf_id in custom_field_ids[:CUSTOM_FIELDS_PER_REQUEST]]
-        response = request(method='get', url=url, headers=headers, params=params)
-        response = response.json()
+        limits = httpx.Limits(max_keepalive_connections=20, max_connections=100)
+        # Les erreurs de connexion sont rejouées par le transport lui-même
+        transport = httpx.AsyncHTTPTransport(limits=limits, retries=MAX_RETRIES)
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        async with httpx.AsyncClient(transport=transport, headers=headers, timeout=10) as client:
+            # Fetch initial batch of data (custom fields included)
+            response = await self._fetch_page(client, url, params, custom_field_ids,
+                                              CUSTOM_FIELDS_PER_REQUEST, MAX_RETRIES)
+
+            # Get Pagination parameters
+            total_results = int((response.get('pagination', {}).get('total', 0))/4)
+            #total_results = 300
+            page_size = params['limit']
+
+            # Chaque page part directement dans le dataset Parquet : la
+            # mémoire reste bornée à une page quel que soit le volume total
+            first_rows = self._page_to_rows(response)
+            self._write_page(first_rows, out_dir, start_offset)
+
+            # Les offsets restants sont connus dès la première page : on les
+            # télécharge en parallèle, bornés par un sémaphore
+            offsets = range(start_offset + page_size, start_offset + total_results, page_size)
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_PAGES)
+
+            # Point de reprise : 'offset' est le plus petit offset dont la page
+            # n'est pas encore écrite, 'done' les pages terminées au-delà (les
+            # pages arrivent dans le désordre) pour ne pas les retélécharger.
+            # Persisté toutes les CHECKPOINT_EVERY pages pour qu'un crash ne
+            # coûte au plus que ce lot de pages
+            checkpoint_path = f"{out_dir}.ckpt"
+            completed_offsets = set()
+            if pagination is not None:
+                try:
+                    with open(checkpoint_path, 'rb') as f:
+                        completed_offsets = set(orjson.loads(f.read()).get('done', []))
+                except FileNotFoundError:
+                    pass
+            # instantané des pages déjà persistées, pour ne pas les relancer :
+            # la marche de la frontière consomme completed_offsets au passage
+            done_pages = frozenset(completed_offsets)
+            frontier = start_offset + page_size  # la première page est déjà écrite
+            # avancer tout de suite sur les pages déjà couvertes par le
+            # checkpoint, au cas où plus aucune page ne resterait à compléter
+            while frontier in completed_offsets:
+                completed_offsets.remove(frontier)
+                frontier += page_size
+            pages_since_checkpoint = 0
+
+            def write_checkpoint():
+                nonlocal pages_since_checkpoint
+                # écriture atomique : un crash en pleine écriture ne doit pas
+                # laisser un checkpoint corrompu
+                with open(f"{checkpoint_path}.tmp", 'wb') as f:
+                    f.write(orjson.dumps({'offset': frontier,
+                                          'done': sorted(completed_offsets)}))
+                os.replace(f"{checkpoint_path}.tmp", checkpoint_path)
+                pages_since_checkpoint = 0
+
+            def advance_checkpoint(offset):
+                nonlocal frontier, pages_since_checkpoint
+                completed_offsets.add(offset)
+                while frontier in completed_offsets:
+                    completed_offsets.remove(frontier)
+                    frontier += page_size
+                pages_since_checkpoint += 1
+                if pages_since_checkpoint >= CHECKPOINT_EVERY:
+                    write_checkpoint()
+
+            with tqdm(total=total_results, desc=f"Downloading {endpoint}-{custom_fields}") as pbar:
+                pbar.update(len(response.get('data', [])))  # update the progress bar
 
-        # Get Pagination parameters
-        total_results = int((response.get('pagination', {}).get('total', 0))/4)
-        #total_results = 300
+                async def fetch_offset(offset):
+                    page_params = dict(params)
+                    page_params['offset'] = offset
+                    async with semaphore:
+                        page = await self._fetch_page(client, url, page_params, custom_field_ids,
+                                                      CUSTOM_FIELDS_PER_REQUEST, MAX_RETRIES)
+                    rows = self._page_to_rows(page)
+                    self._write_page(rows, out_dir, offset)
+                    advance_checkpoint(offset)
+                    pbar.update(len(page.get('data', [])))  # update the progress bar
+
+                await asyncio.gather(*(fetch_offset(offset)
+                                       for offset in offsets
+                                       if offset not in done_pages))
+                if offsets:
+                    write_checkpoint()
+
+        # La frontière compte aussi les pages sautées car déjà dans le
+        # checkpoint ; start_offset + total_rows les ignorerait et renverrait
+        # un offset en plein milieu de données déjà persistées
+        last_offset = frontier
+        print(f"Stoped at the pagination index : {last_offset}")
+        return out_dir, last_offset
+
+    def _write_page(self, rows: list, out_dir: str, offset: int) -> None:
+        """
+        Appends one page of flattened rows to the partitioned Parquet dataset.
+        """
+        if not rows:
+            return
+        table = pa.Table.from_pylist(rows)
+        table = table.append_column('offset_bucket', pa.array([offset // 1000] * len(rows)))
+        pq.write_to_dataset(table, root_path=out_dir, partition_cols=['offset_bucket'])
+
+    async def _fetch_page(self, client, url: str, params: dict, custom_field_ids: list,
+                          batch_size: int, max_retries: int) -> dict:
+        """
+        Fetches one page plus its additional custom-field batches (concurrently)
+        and merges the extra custom fields into the page items.
+        """
+        params = dict(params)
+        params['embed[]'] = [f"cf.{cf_id}" for cf_id in custom_field_ids[:batch_size]]
+        response = await self._get_json(client, url, params, max_retries)
 
         # Fetch additional custom fields in batches and merge them with initial items
-        for i in range(CUSTOM_FIELDS_PER_REQUEST, len(custom_field_ids), CUSTOM_FIELDS_PER_REQUEST):
-            batch_custom_fields = custom_field_ids[i:i+CUSTOM_FIELDS_PER_REQUEST]
-            params['embed[]'] = [f"cf.{cf_id}" for cf_id in batch_custom_fields]
-
-            additional_data = request('get', url, headers=headers, params=params, timeout=10)
-            additional_data = additional_data.json()
-
-            # Merge custom fields into each item
-
-            for additional_item in additional_data['data']: # obligé de faire ça au cas où il y a i un écalage dans l'ordre de réponse de Sellsy
-                if additional_item['_embed']['custom_fields'] is not None :
-                    for original_data in response['data']:
-                        if original_data['id']==additional_item['id'] and original_data['created']==additional_item['created']:
+        batch_requests = []
+        for i in range(batch_size, len(custom_field_ids), batch_size):
+            batch_params = dict(params)
+            batch_params['embed[]'] = [f"cf.{cf_id}" for cf_id in custom_field_ids[i:i+batch_size]]
+            batch_requests.append(self._get_json(client, url, batch_params, max_retries))
+
+        if batch_requests:
+            # Index (id, created) -> item construit une seule fois : la fusion
+            # devient un accès dict au lieu d'un parcours de la page entière
+            # pour chaque élément (obligé de faire ça au cas où il y a un
+            # décalage dans l'ordre de réponse de Sellsy)
+            index = {(d['id'], d['created']): d for d in response['data']}
+            for additional_data in await asyncio.gather(*batch_requests):
+                # Merge custom fields into each item
+                for additional_item in additional_data['data']:
+                    if additional_item['_embed']['custom_fields'] is not None :
+                        original_data = index.get((additional_item['id'], additional_item['created']))
+                        if original_data is not None:
                             original_data['_embed']['custom_fields'].extend(additional_item['_embed']['custom_fields'])
-                            break
+        return response
 
+    async def _get_json(self, client, url: str, params: dict, max_retries: int) -> dict:
+        """
+        Fetches one JSON response. Connection errors are retried by the
+        transport; retryable statuses honour Retry-After (httpx has no
+        equivalent of urllib3.Retry for statuses).
+        """
+        for attempt in range(max_retries):
+            response = await client.get(url, params=params)
+            if response.status_code in (429, 500, 502, 503, 504) and attempt < max_retries - 1:
+                try:
+                    # Retry-After peut aussi être une date HTTP : dans ce cas
+                    # on retombe sur le backoff exponentiel
+                    delay = float(response.headers['Retry-After'])
+                except (KeyError, ValueError):
+                    delay = 0.5 * (2 ** attempt)
+                await asyncio.sleep(delay)
+                continue
+            response.raise_for_status()
+            return orjson.loads(response.content)
+
+    def _page_to_rows(self, response: dict) -> list:
         raw_data = [flatten_dict(d) for d in response.get('data', [])]
         for client in raw_data:
-            for cf in client['_embed_custom_fields']:
-                if cf['value'] is not None:
-                    for item in cf['parameters'].get('items', []):
-                        if item['id'] == cf['value']:
-                            client[cf['name']] = item['label']
-                            break
-            del client['_embed_custom_fields']
-        all_data = pd.DataFrame(raw_data)
-        all_data.dropna(axis=1, inplace=True, how = 'all')
-        params['offset'] = response.get('pagination', {}).get('offset', 0)
-
-        with tqdm(total=total_results, desc=f"Downloading {endpoint}-{custom_fields}") as pbar:
-            pbar.update(len(response.get('data', [])))  # update the progress bar
-            while len(all_data) < total_results:
-                retries = 0
+            # Deux accès dict par valeur grâce à _cf_meta, au lieu de
+            # rebalayer parameters['items'] pour chaque champ de chaque ligne
+            for cf in client.pop('_embed_custom_fields', None) or []:
+                meta = self._cf_meta.get(cf['id'])
+                value = cf['value']
+                if value is None or meta is None:
+                    continue
                 try:
-                    params['embed[]'] = [f"cf.{cf_id}" for cf_id in custom_field_ids[:CUSTOM_FIELDS_PER_REQUEST]]
-                    response = request(method='get', url=url, headers=headers, params=params).json()
-                    # get custom fields
-                    for i in range(CUSTOM_FIELDS_PER_REQUEST, len(custom_field_ids), CUSTOM_FIELDS_PER_REQUEST):
-                        batch_custom_fields = custom_field_ids[i:i+CUSTOM_FIELDS_PER_REQUEST]
-                        params['embed[]'] = [f"cf.{cf_id}" for cf_id in batch_custom_fields]
-                        additional_data = request('get', url, headers=headers, params=params).json()
-
-                        for additional_item in additional_data['data']: # obligé de faire ça au cas où il y a i un écalage dans l'ordre de réponse de Sellsy
-                            if additional_item['_embed']['custom_fields'] is not None :
-                                for original_data in response['data']:
-                                    if original_data['id']==additional_item['id'] and original_data['created']==additional_item['created']:
-                                        original_data['_embed']['custom_fields'].extend(additional_item['_embed']['custom_fields'])
-                                        break
-
-                except :
-                    retries += 1
-                    print(f'error - doing {retries} retry')
-                    sleep(2 ** retries)  # Exponential backoff
-                    if retries == MAX_RETRIES:
-                        print(f"error on the {params['offset']} page of {endpoint}")
-                        return all_data, pagination_info['offset']                   
-
-                raw_data = [flatten_dict(d) for d in response.get('data', [])]
-                for client in raw_data:
-                    for cf in client['_embed_custom_fields']:
-                        if cf['value'] is not None:
-                            for item in cf['parameters'].get('items', []):
-                                if item['id'] == cf['value']:
-                                    client[cf['name']] = item['label']
-                                    break
-                    del client['_embed_custom_fields']
-                raw_data = pd.DataFrame(raw_data)
-                raw_data.dropna(axis=1, inplace=True, how = 'all')
-                all_data = pd.concat([all_data, raw_data])
-
-                pbar.update(len(response.get('data', [])))  # update the progress bar
-                pagination_info = response.get('pagination', {})
-                if pagination_info['offset']:
-                    params['offset'] = pagination_info['offset']
-                else:
-                    print('End of pagination')
-                    break
- 
-        print(f"Stoped at the pagination index : {pagination_info['offset']}")
-        return all_data, pagination_info['offset']
+                    label = meta['items'].get(value)
+                except TypeError:
+                    # valeur non hachable (ex. montant {'amount': ..., 'currency': ...})
+                    label = None
+                # Les valeurs sans label (item supprimé, champ libre) sont
+                # figées en str : mélanger labels str et ids bruts dans une
+                # même colonne casse l'écriture et la relecture Arrow
+                client[meta['name']] = label if label is not None else str(value)
+        return raw_data
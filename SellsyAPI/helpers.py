@@ -1,4 +1,13 @@
+from pathlib import Path
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset
+import pyarrow.parquet as pq
+
+# Table de translation construite une seule fois : une passe C par nom de
+# champ au lieu d'un .replace() par caractère à remplacer
+_ACCENT_MAP = str.maketrans({'é': 'e', 'è': 'e', 'ë': 'e', 'ê': 'e', 'ô': 'o', '(': '', ')': ''})
+_NULL_LABELS = frozenset({'Inconnu', 'N/C', 'Aucun'})
 
 def flatten_dict(d, parent_key='', sep='_'):
     """
@@ -12,14 +21,39 @@ def flatten_dict(d, parent_key='', sep='_'):
     Returns:
         dict: Dictionnaire aplati.
     """
-    items = []
-    for k, v in d.items():
-        new_key = f"{parent_key}{sep}{k}" if parent_key else k
-        if isinstance(v, dict):
-            items.extend(flatten_dict(v, new_key, sep=sep).items())
-        else:
-            items.append((new_key, v))
-    return dict(items)
+    # Parcours itératif avec une pile explicite : pas de frame Python ni de
+    # dict intermédiaire par niveau d'imbrication
+    out = {}
+    stack = [(parent_key, d)]
+    while stack:
+        prefix, node = stack.pop()
+        for k, v in node.items():
+            new_key = f"{prefix}{sep}{k}" if prefix else k
+            if type(v) is dict:
+                stack.append((new_key, v))
+            else:
+                out[new_key] = v
+    return out
+
+def read_parquet_dataset(root_dir) -> pd.DataFrame:
+    """
+    Recharge en un DataFrame un dataset Parquet écrit page par page.
+
+    Les fragments n'ont pas forcément tous les mêmes colonnes (une colonne de
+    champ personnalisé n'apparaît que sur les pages où elle est renseignée) :
+    le schéma est donc unifié sur l'ensemble des fichiers avant lecture.
+
+    Args:
+        root_dir (str): Répertoire racine du dataset.
+
+    Returns:
+        pd.DataFrame: L'ensemble des lignes du dataset.
+    """
+    files = sorted(str(p) for p in Path(root_dir).rglob('*.parquet'))
+    if not files:
+        return pd.DataFrame()
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files])
+    return pa.dataset.dataset(files, schema=schema).to_table().to_pandas()
 
 def find_label_by_id(data_dict, search_id):
     """
@@ -39,13 +73,15 @@ def find_label_by_id(data_dict, search_id):
 
 def treat_custom_fields(custom_field):
     return_list=[]
-    mapping = [('é', 'e'), ('è', 'e'), ('ë', 'e'), ('ê', 'e'), ('ô', 'o'), ('(',''),(')','')]
+    # Le même dictionnaire 'parameters' revient pour de nombreux champs : la
+    # table id -> label n'est construite qu'une fois par dictionnaire au lieu
+    # d'un parcours linéaire des items à chaque valeur
+    labels_cache = {}
     for item in custom_field:
-        for k, v in mapping:
-            item['name'] = item['name'].replace(k, v)
+        item['name'] = item['name'].translate(_ACCENT_MAP)
         name = item['name']
-        
-        
+
+
         if item['value'] in [0, '0', '']:
             value = None
         elif isinstance(item['value'], dict) and "amount" in item['value'] and "currency" in item['value']:
@@ -54,23 +90,35 @@ def treat_custom_fields(custom_field):
             else :
                 value = None
         else :
-            value = find_label_by_id(item['parameters'],item['value'])
+            parameters = item['parameters']
+            labels = labels_cache.get(id(parameters))
+            if labels is None:
+                # reversed : en cas d'id dupliqué, la première occurrence gagne
+                # comme avec l'ancien parcours linéaire
+                labels = {i.get('id'): i.get('label') for i in reversed(parameters.get('items', []))}
+                labels_cache[id(parameters)] = labels
+            try:
+                value = labels.get(item['value'], item['value'])
+            except TypeError:
+                # valeur non hachable (multi-sélection en liste, dict
+                # inattendu) : la passer telle quelle, comme l'ancien parcours
+                value = item['value']
             #value = item['value']
-            if value == 'Inconnu' or value == 'N/C' or value == 'Aucun':
+            if isinstance(value, str) and value in _NULL_LABELS:
                 value = None
 
         return_list.append({name:value})
     return return_list
 
 def expand_list_of_dicts_column(df: pd.DataFrame, column_name='_embed_custom_fields') -> pd.DataFrame:
-    def dict_list_to_df(dict_list):
-        # S'assurer que chaque élément de la liste est un dictionnaire
-        dict_list = [d for d in dict_list if isinstance(d, dict)]
-        combined_dict = {k: v for d in dict_list for k, v in d.items()}
-        return pd.Series(combined_dict)
-
-    # Appliquer la fonction sur chaque ligne de la colonne spécifiée et créer un nouveau DataFrame
-    expanded_df = df[column_name].apply(dict_list_to_df)
+    # Fusionner les dictionnaires de chaque ligne en un seul dict (en ignorant
+    # tout élément qui n'est pas un dictionnaire), puis construire le DataFrame
+    # étendu en une seule passe au lieu d'une pd.Series par ligne
+    records = [
+        {k: v for d in cell if isinstance(d, dict) for k, v in d.items()}
+        for cell in df[column_name]
+    ]
+    expanded_df = pd.DataFrame.from_records(records, index=df.index)
 
     # Joindre le nouveau DataFrame avec l'original en excluant la colonne transformée
-    return df.drop(columns=[column_name]).join(expanded_df)
+    return pd.concat([df.drop(columns=[column_name]), expanded_df], axis=1)
@@ -1,7 +1,10 @@
 from pandas import to_datetime
 from SellsyAPI.client import SellsyAPI
+from SellsyAPI.helpers import read_parquet_dataset
 from project_secrets import client_id, client_secret
+import json
 import os
+import shutil
 
 api_client = SellsyAPI(
     client_id = client_id,
@@ -18,27 +21,63 @@ mapper = [ #client, prospect, contact, opportunity, document, supplier, purchase
 for endpoint, custom_fields in mapper:
     print(f'{endpoint} - {custom_fields}')
 
-    # Vérifier l'existence d'un fichier précédent
-    existing_file = f'{endpoint}-{custom_fields}-*.csv'
-    matching_files = [f for f in os.listdir('.') if f.startswith(existing_file)]
-    if matching_files:
-        # Prendre le dernier fichier (supposé le plus récent)
-        latest_file = sorted(matching_files)[-1]
-        # Extraire la pagination du nom de fichier
-        pagination = latest_file.split('-')[-1].replace('.csv', '')
+    # Reprendre en priorité depuis le checkpoint écrit par get() ; à défaut,
+    # retomber sur la pagination extraite du nom du dernier fichier CSV
+    ckpt_file = f'{endpoint}-{custom_fields}-parquet.ckpt'
+    if os.path.exists(ckpt_file):
+        with open(ckpt_file) as f:
+            pagination = json.load(f).get('offset')
     else:
-        pagination = None
+        existing_file = f'{endpoint}-{custom_fields}-*.csv'
+        matching_files = [f for f in os.listdir('.') if f.startswith(existing_file)]
+        if matching_files:
+            # Prendre le dernier fichier (supposé le plus récent)
+            latest_file = sorted(matching_files)[-1]
+            # Extraire la pagination du nom de fichier
+            pagination = latest_file.split('-')[-1].replace('.csv', '')
+        else:
+            pagination = None
 
-    data, pagination= api_client.get(
+    # Les pages sont écrites au fil de l'eau dans un dataset Parquet ; le
+    # DataFrame n'est reconstruit qu'ici, hors du chemin réseau
+    parquet_dir, pagination = api_client.get(
         endpoint=endpoint,
         params={},
         custom_fields=custom_fields,
-        pagination=pagination
+        pagination=pagination,
+        out_dir=f'{endpoint}-{custom_fields}-parquet'
     )
-    for item in ['due_date', 'created', 'created_at', 'birth_date', 'Date de Rituel choisie', 'updated_status', 'updated_at', "Date d'admissibilite", 'Date de naissance']:
-        try:
-            data[item] = to_datetime(data[item], format='ISO8601', utc=True)
-        except:
-            pass
+    data = read_parquet_dataset(parquet_dir)
+    # Équivalent de dropna(axis=1, how='all') en une seule réduction
+    # vectorisée, sans repasse ligne à ligne sur l'axe des labels
+    data = data.iloc[:, data.notna().to_numpy().any(axis=0)]
+
+    # Les colonnes de labels (listes déroulantes) n'ont qu'une poignée de
+    # valeurs distinctes : le dtype category réduit d'autant la mémoire des
+    # traitements qui suivent, sans changer la sérialisation CSV
+    if len(data):
+        for col in data.select_dtypes(include=['object', 'str']).columns:
+            nunique = data[col].nunique(dropna=True)
+            if nunique and nunique / len(data) < 0.5:
+                data[col] = data[col].astype('category')
+    # Parser les colonnes de dates réellement présentes en un seul passage
+    # vectorisé ; errors='coerce' remplace le try/except par colonne (les
+    # valeurs invalides deviennent NaT). Une colonne candidate qui ne contient
+    # aucune date reste inchangée, comme avec l'ancien try/except
+    date_candidates = ['due_date', 'created', 'created_at', 'birth_date', 'Date de Rituel choisie', 'updated_status', 'updated_at', "Date d'admissibilite", 'Date de naissance']
+    date_cols = [col for col in date_candidates if col in data.columns]
+
+    def parse_dates(s):
+        parsed = to_datetime(s, format='ISO8601', utc=True, errors='coerce')
+        return parsed if parsed.notna().any() or s.isna().all() else s
+
+    data[date_cols] = data[date_cols].apply(parse_dates)
 
     data.to_csv(f'{endpoint}-{custom_fields}-{pagination}.csv', index=False)
+
+    # Le téléchargement est allé au bout : le point de reprise et le dataset
+    # intermédiaire n'ont plus lieu d'être (le laisser ferait repartir la
+    # prochaine exécution sur d'anciens fragments)
+    if os.path.exists(ckpt_file):
+        os.remove(ckpt_file)
+    shutil.rmtree(parquet_dir, ignore_errors=True)